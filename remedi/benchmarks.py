@@ -1,14 +1,16 @@
 """Standalone functions for benchmarking editor performance across metrics."""
 import logging
+import math
 import random
 from collections import OrderedDict, defaultdict
 from dataclasses import dataclass
+from functools import partial
 from itertools import chain
-from typing import Any, Callable, Sequence, cast
+from typing import Any, Callable, Iterable, Sequence, cast
 
 from remedi import data, editors, metrics, models, precompute
 from remedi.utils import experiment_utils
-from remedi.utils.typing import Dataset, Device, StrSequence
+from remedi.utils.typing import Dataset, Device, ModelInput, StrSequence, Tokenizer
 
 import numpy as np
 import scipy.stats
@@ -16,7 +18,6 @@ import torch
 import torch.utils.data
 from dataclasses_json import DataClassJsonMixin
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics import accuracy_score, f1_score, matthews_corrcoef
 from tqdm.auto import tqdm
 
 logger = logging.getLogger(__name__)
@@ -102,10 +103,24 @@ def essence(
     top_k_sampling: int = DEFAULT_TOP_K_SAMPLING,
     use_references: Sequence[StrSequence] | None = None,
     tfidf_vectorizer: TfidfVectorizer | None = None,
+    fuse_references: bool = False,
+    num_workers: int = 0,
+    prefetch_factor: int | None = None,
     desc: str | None = None,
     device: Device | None = None,
 ) -> EssenceBenchmarkResults:
-    """Measures how well the editor preserves the edited entity's essence."""
+    """Measures how well the editor preserves the edited entity's essence.
+
+    If `fuse_references` is set and the references are generated here from the same
+    prompts as the edited text, both are produced by one generate call per batch
+    instead of two. That call runs on 2 * `batch_size` rows, so peak memory roughly
+    doubles; lower `batch_size` if it no longer fits.
+
+    By default batches are read directly from the Arrow table in the main process.
+    If `num_workers` > 0, they are instead loaded by that many DataLoader worker
+    processes, each prefetching `prefetch_factor` batches, so the next batch is
+    ready while the model generates on the current one.
+    """
     if editor is None and mt is None:
         raise ValueError("must set at least one of `editor` and `mt`")
     if isinstance(prompt_template, str) and prompt_template.count("{}") != 1:
@@ -134,113 +149,170 @@ def essence(
         top_k=top_k_sampling,
     )
 
+    # Fusing only applies if the unedited references come from the same prompts as
+    # the edited generations.
+    fuse_references = (
+        fuse_references
+        and editor is not None
+        and use_references is None
+        and reference_prompt_template == prompt_template
+        and reference_prompt_prefix == prompt_prefix
+    )
+
+    # Build and tokenize all prompts up front. Each map batch is padded to its own
+    # longest prompt, and since the map and the loader below use the same batch
+    # size, every loader batch lines up with one map batch and can be stacked.
+    dataset = dataset.map(
+        partial(
+            _essence_inputs_from_batch,
+            mt.tokenizer,
+            prompt_template=prompt_template,
+            prompt_prefix=prompt_prefix,
+            output_key="essence_prompt",
+        ),
+        batched=True,
+        batch_size=batch_size,
+        desc=f"{desc} [tokenize]",
+        keep_in_memory=True,
+    )
+    if use_references is None and not fuse_references:
+        dataset = dataset.map(
+            partial(
+                _essence_inputs_from_batch,
+                mt.tokenizer,
+                prompt_template=reference_prompt_template,
+                prompt_prefix=reference_prompt_prefix,
+                output_key="essence_reference_prompt",
+            ),
+            batched=True,
+            batch_size=batch_size,
+            desc=f"{desc} [tokenize references]",
+            keep_in_memory=True,
+        )
+
     generations = []
     reference_groups: list[list[str]] = []
-    essence_scores = []
     fluency_generation_scores = []
     fluency_references_scores = []
-    with dataset.formatted_as("torch"):
-        loader = torch.utils.data.DataLoader(
-            cast(torch.utils.data.Dataset, dataset), batch_size=batch_size
+
+    # Without workers, read whole batches straight out of Arrow instead of going
+    # through the DataLoader's per-row fetch and collate.
+    dataset = dataset.with_format("torch")
+    batches: Iterable[dict]
+    if num_workers > 0:
+        loader_kwargs: dict = dict(
+            num_workers=num_workers, prefetch_factor=prefetch_factor
         )
-        for batch_index, batch in enumerate(tqdm(loader, desc=f"{desc} [generate]")):
-            ids = batch["id"]
-            entities = batch["entity"]
-            attributes = batch["attribute"]
-
-            # Step 1: If needed, generate reference texts.
-            if use_references is None:
-                reference_prompts = _create_essence_prompts(
-                    batch,
-                    prompt_template=reference_prompt_template,
-                    prompt_prefix=reference_prompt_prefix,
-                )
-                with models.set_padding_side(mt, padding_side="left"):
-                    reference_inputs, _ = precompute.inputs_from_batch(
-                        mt, reference_prompts, device=device
-                    )
-                reference_outputs = mt.model.generate(
-                    **reference_inputs, **generate_kwargs
-                )
-                batch_reference_groups = [
-                    [r]
-                    for r in mt.tokenizer.batch_decode(
-                        reference_outputs, skip_special_tokens=True
-                    )
-                ]
-                if reference_prompt_prefix is not None:
-                    batch_reference_groups = [
-                        [r[len(reference_prompt_prefix) :]]
-                        for [r] in batch_reference_groups
-                    ]
-                if reference_post_process is not None:
-                    batch_reference_groups = [
-                        [reference_post_process(r)] for [r] in batch_reference_groups
-                    ]
-            else:
-                start = batch_index * batch_size
-                end = start + len(entities)
-                batch_reference_groups = [list(rs) for rs in use_references[start:end]]
-            reference_groups += batch_reference_groups
-
-            # Step 2: Generate post-edit text.
-            prompts = _create_essence_prompts(
-                batch, prompt_template=prompt_template, prompt_prefix=prompt_prefix
-            )
-            with models.set_padding_side(mt, padding_side="left"):
-                inputs, _ = precompute.inputs_from_batch(mt, prompts, device=device)
-            if editor is not None:
-                with editors.apply(
-                    editor, alpha=alpha, beta=beta, device=device
-                ) as edited_mt:
-                    outputs = edited_mt.model.generate(
-                        data.ContextMediationBatch(
-                            id=ids,
-                            source=batch["source"],
-                            entity=entities,
-                            prompt=prompts,
-                            attribute=attributes,
-                            context=batch["context"],
-                            target_mediated=None,
-                            target_unmediated=None,
-                        ),
-                        inputs=inputs,
-                        padding_side="left",
-                        **generate_kwargs,
-                    )
-            else:
-                outputs = mt.model.generate(**inputs, **generate_kwargs)
+        if device is not None and torch.device(device).type == "cuda":
+            loader_kwargs["pin_memory"] = True
+        batches = torch.utils.data.DataLoader(
+            cast(torch.utils.data.Dataset, dataset),
+            batch_size=batch_size,
+            **loader_kwargs,
+        )
+    else:
+        batches = dataset.iter(batch_size=batch_size)
 
-            batch_generations = mt.tokenizer.batch_decode(
-                outputs, skip_special_tokens=True
+    for batch_index, batch in enumerate(
+        tqdm(
+            batches,
+            total=math.ceil(len(dataset) / batch_size),
+            desc=f"{desc} [generate]",
+        )
+    ):
+        ids = batch["id"]
+        entities = batch["entity"]
+        attributes = batch["attribute"]
+
+        # Step 1: If needed, generate reference texts.
+        reference_texts = None
+        if use_references is None and not fuse_references:
+            reference_inputs = _essence_inputs_from_precomputed(
+                batch, "essence_reference_prompt", device=device
+            )
+            reference_outputs = mt.model.generate(**reference_inputs, **generate_kwargs)
+            reference_texts = mt.tokenizer.batch_decode(
+                reference_outputs, skip_special_tokens=True
             )
-            if prompt_prefix is not None:
-                batch_generations = [g[len(prompt_prefix) :] for g in batch_generations]
-            if post_process is not None:
-                batch_generations = [post_process(g) for g in batch_generations]
-            generations += batch_generations
-
-            for sid, entity, attribute, generation, references in zip(
-                ids,
-                entities,
-                attributes,
-                batch_generations,
-                batch_reference_groups,
-            ):
-                logger.debug(f"ID={sid} ENTITY={entity}, ATTR={attribute}")
-                logger.debug(f"ID={sid} REFERENCES={references}")
-                logger.debug(f"ID={sid} GENERATION={generation}")
 
-                essence_score = metrics.tfidf_similarity(
-                    generation, references, tfidf_vectorizer
+        # Step 2: Generate post-edit text. When fusing, the prompts are repeated
+        # and the editor only edits the first copy of each.
+        prompts = batch["essence_prompt"]
+        inputs = _essence_inputs_from_precomputed(
+            batch,
+            "essence_prompt",
+            repeat=2 if fuse_references else 1,
+            device=device,
+        )
+        if editor is not None:
+            with editors.apply(
+                editor, alpha=alpha, beta=beta, device=device
+            ) as edited_mt:
+                outputs = edited_mt.model.generate(
+                    data.ContextMediationBatch(
+                        id=ids,
+                        source=batch["source"],
+                        entity=entities,
+                        prompt=prompts,
+                        attribute=attributes,
+                        context=batch["context"],
+                        target_mediated=None,
+                        target_unmediated=None,
+                    ),
+                    inputs=inputs,
+                    padding_side="left",
+                    **generate_kwargs,
                 )
-                essence_scores.append(essence_score)
+        else:
+            outputs = mt.model.generate(**inputs, **generate_kwargs)
 
-                fluency_generation_score = metrics.weighted_n_gram_entropy(generation)
-                fluency_generation_scores.append(fluency_generation_score)
+        batch_generations = mt.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+        if fuse_references:
+            reference_texts = batch_generations[len(prompts) :]
+            batch_generations = batch_generations[: len(prompts)]
 
-                fluency_references_score = metrics.weighted_n_gram_entropy(references)
-                fluency_references_scores.append(fluency_references_score)
+        if reference_texts is not None:
+            if reference_prompt_prefix is not None:
+                reference_texts = [
+                    r[len(reference_prompt_prefix) :] for r in reference_texts
+                ]
+            if reference_post_process is not None:
+                reference_texts = [reference_post_process(r) for r in reference_texts]
+            batch_reference_groups = [[r] for r in reference_texts]
+        else:
+            assert use_references is not None
+            start = batch_index * batch_size
+            end = start + len(entities)
+            batch_reference_groups = [list(rs) for rs in use_references[start:end]]
+        reference_groups += batch_reference_groups
+
+        if prompt_prefix is not None:
+            batch_generations = [g[len(prompt_prefix) :] for g in batch_generations]
+        if post_process is not None:
+            batch_generations = [post_process(g) for g in batch_generations]
+        generations += batch_generations
+
+        for sid, entity, attribute, generation, references in zip(
+            ids,
+            entities,
+            attributes,
+            batch_generations,
+            batch_reference_groups,
+        ):
+            logger.debug(f"ID={sid} ENTITY={entity}, ATTR={attribute}")
+            logger.debug(f"ID={sid} REFERENCES={references}")
+            logger.debug(f"ID={sid} GENERATION={generation}")
+
+            fluency_generation_score = metrics.weighted_n_gram_entropy(generation)
+            fluency_generation_scores.append(fluency_generation_score)
+
+            fluency_references_score = metrics.weighted_n_gram_entropy(references)
+            fluency_references_scores.append(fluency_references_score)
+
+    # Vectorize all generations and references at once instead of per sample.
+    essence_scores = metrics.batch_tfidf_similarity(
+        generations, reference_groups, tfidf_vectorizer
+    ).tolist()
 
     samples = [
         EssenceSample(
@@ -277,6 +349,41 @@ def essence(
     )
 
 
+def _essence_inputs_from_batch(
+    tokenizer: Tokenizer,
+    batch: dict,
+    prompt_template: str | PromptTemplateFn = DEFAULT_PROMPT_TEMPLATE,
+    prompt_prefix: str | None = DEFAULT_PROMPT_PREFIX,
+    output_key: str = "essence_prompt",
+) -> dict:
+    """Create essence prompts for the batch and tokenize them, padded on the left."""
+    prompts = _create_essence_prompts(
+        batch, prompt_template=prompt_template, prompt_prefix=prompt_prefix
+    )
+    with models.set_padding_side(tokenizer, padding_side="left"):
+        inputs = tokenizer(prompts, truncation=True, padding="longest")
+    return {
+        output_key: prompts,
+        f"{output_key}.input_ids": inputs.input_ids,
+        f"{output_key}.attention_mask": inputs.attention_mask,
+    }
+
+
+def _essence_inputs_from_precomputed(
+    batch: dict, key: str, repeat: int = 1, device: Device | None = None
+) -> ModelInput:
+    """Read tokenized prompts precomputed by `_essence_inputs_from_batch`."""
+    inputs = ModelInput(
+        {
+            "input_ids": batch[f"{key}.input_ids"].repeat(repeat, 1),
+            "attention_mask": batch[f"{key}.attention_mask"].repeat(repeat, 1),
+        }
+    )
+    if device is not None:
+        inputs = inputs.to(device)
+    return inputs
+
+
 def _create_essence_prompts(
     batch: dict,
     prompt_template: str | PromptTemplateFn = DEFAULT_PROMPT_TEMPLATE,
@@ -385,6 +492,7 @@ def classification(
     control_task: bool = False,
     control_task_seed: int | None = None,
     batch_size: int = editors.DEFAULT_BATCH_SIZE,
+    inference_batch_size: int | None = None,
     entity_layer: int | None = None,
     desc: str | None = None,
     device: Device | None = None,
@@ -395,7 +503,10 @@ def classification(
     Args:
         editor: The editor to benchmark.
         dataset: The dataset to benchmark on.
-        batch_size: Max number of samples to process at once.
+        batch_size: Max number of samples to run through the LM at once.
+        inference_batch_size: Max number of samples to classify at once. Classifying
+            only runs the editor on precomputed reps, not the LM, so this can be
+            much larger than `batch_size`. Defaults to 4 * `batch_size`.
         control_task: If set, randomly assign ground truth labels to each sample.
             Note, if you want to test a control *editor* and/or control *model*, just
             pass them in via the `editor` arg.
@@ -414,6 +525,9 @@ def classification(
     if desc is None:
         desc = "classification benchmark"
 
+    if inference_batch_size is None:
+        inference_batch_size = 4 * batch_size
+
     if entity_layer is None:
         entity_layer = editor.layer
     layers = sorted({editor.layer, entity_layer})
@@ -432,36 +546,73 @@ def classification(
         runs[task] = editor.classify(
             dataset=precomputed,
             take_entity_from="prompt_in_context" if task == "contextual" else "prompt",
-            batch_size=batch_size,
+            batch_size=inference_batch_size,
             entity_layer=entity_layer,
             device=device,
             desc=f"{desc} [classify {task}]",
             **kwargs,
         ).results
 
+    # Materialize every score once as an array, so labels and predictions for both
+    # tasks come from vectorized comparisons rather than per-sample properties.
+    logps = {
+        key: np.asarray(precomputed[key], dtype=float)
+        for key in (
+            "prompt_in_context.target.logp",
+            "prompt_in_context.comparator.logp",
+            "prompt.target.logp",
+            "prompt.comparator.logp",
+        )
+    }
+    scores = {
+        task: {
+            kind: np.fromiter(
+                (getattr(run, f"score_{kind}") for run in runs[task]), dtype=float
+            )
+            for kind in ("mediated", "unmediated")
+        }
+        for task in ("contextual", "decontextual")
+    }
+    outputs = {
+        "contextual": dict(
+            logp_target=logps["prompt_in_context.target.logp"],
+            logp_comparator=logps["prompt_in_context.comparator.logp"],
+            score_target=scores["contextual"]["mediated"],
+            score_comparator=scores["contextual"]["unmediated"],
+        ),
+        "decontextual": dict(
+            logp_target=logps["prompt.target.logp"],
+            logp_comparator=logps["prompt.comparator.logp"],
+            score_target=scores["decontextual"]["unmediated"],
+            score_comparator=scores["decontextual"]["mediated"],
+        ),
+    }
+
+    values = {
+        task: {field: array.tolist() for field, array in task_outputs.items()}
+        for task, task_outputs in outputs.items()
+    }
     samples = []
-    for pre, rc, rd in zip(precomputed, runs["contextual"], runs["decontextual"]):
+    for index, rc in enumerate(runs["contextual"]):
+        contextual, decontextual = (
+            ClassifierOutputs(
+                logp_target=values[task]["logp_target"][index],
+                logp_comparator=values[task]["logp_comparator"][index],
+                score_target=values[task]["score_target"][index],
+                score_comparator=values[task]["score_comparator"][index],
+            )
+            for task in ("contextual", "decontextual")
+        )
         sample = ClassificationSample(
-            id=rc.sample["id"],
-            contextual=ClassifierOutputs(
-                logp_target=pre["prompt_in_context.target.logp"],
-                logp_comparator=pre["prompt_in_context.comparator.logp"],
-                score_target=rc.score_mediated,
-                score_comparator=rc.score_unmediated,
-            ),
-            decontextual=ClassifierOutputs(
-                logp_target=pre["prompt.target.logp"],
-                logp_comparator=pre["prompt.comparator.logp"],
-                score_target=rd.score_unmediated,
-                score_comparator=rd.score_mediated,
-            ),
+            id=rc.sample["id"], contextual=contextual, decontextual=decontextual
         )
         samples.append(sample)
 
     benchmark_results_kwargs: dict = defaultdict(dict)
     for task in ("contextual", "decontextual"):
-        y_true = [getattr(sample, task).label for sample in samples]
-        y_pred = [getattr(sample, task).prediction for sample in samples]
+        task_outputs = outputs[task]
+        y_true = task_outputs["logp_target"] > task_outputs["logp_comparator"]
+        y_pred = task_outputs["score_target"] > task_outputs["score_comparator"]
 
         # If evaluating on the control task, randomly pick ground truth labels while
         # preserving class balance.
@@ -469,16 +620,16 @@ def classification(
             logger.info(
                 f"control_task=True (seed={control_task_seed}), shuffling labels"
             )
-            y_true = _make_control_task(y_true, seed=control_task_seed)
+            y_true = np.array(
+                _make_control_task(y_true.tolist(), seed=control_task_seed)
+            )
 
         # We want to classify whether the model will *not* make the correct prediction.
         # This does not change accuracy/mcc but does change f1.
-        y_true = [not x for x in y_true]
-        y_pred = [not x for x in y_pred]
+        y_true = ~y_true
+        y_pred = ~y_pred
 
-        accuracy = accuracy_score(y_true, y_pred)
-        f1 = f1_score(y_true, y_pred)
-        mcc = matthews_corrcoef(y_true, y_pred)
+        accuracy, f1, mcc = metrics.binary_classification_scores(y_true, y_pred)
         benchmark_results_kwargs[task] = ClassifierTaskMetrics(
             f1=f1, mcc=mcc, accuracy=accuracy
         )
@@ -602,6 +753,7 @@ def counterfact_paraphrase(
     editor: editors.Editor | None = None,
     mt: models.ModelAndTokenizer | None = None,
     dataset: Dataset,
+    flatten: bool = True,
     desc: str | None = None,
     **kwargs: Any,
 ) -> CounterFactParaphraseBenchmarkResults:
@@ -614,12 +766,17 @@ def counterfact_paraphrase(
 
         prompts = sample["source"]["generation_prompts"]
 
+    If the same dataset is benchmarked many times (e.g., for editors at different
+    layers), flatten it once with `counterfact_select_and_flatten` and pass
+    `flatten=False` to skip redoing it on every call.
+
     """
     if desc is None:
         desc = "paraphrase benchmark"
-    dataset = _counterfact_select_and_flatten(
-        dataset, "paraphrase_prompts", desc=f"{desc} [flatten dataset]"
-    )
+    if flatten:
+        dataset = counterfact_select_and_flatten(
+            dataset, "paraphrase_prompts", desc=f"{desc} [flatten dataset]"
+        )
     efficacy_benchmark = efficacy(
         editor=editor,
         mt=mt,
@@ -633,15 +790,12 @@ def counterfact_paraphrase(
         results_by_sample_id[result.id].append(result)
     results_by_sample_id = OrderedDict(results_by_sample_id)
 
+    # Score the grouped results as flat arrays, in the same order as the groups.
+    grouped_results = list(chain.from_iterable(results_by_sample_id.values()))
     efficacy_metrics = metrics.efficacy(
-        [
-            [result.target_score for result in results]
-            for results in results_by_sample_id.values()
-        ],
-        [
-            [result.comparator_score for result in results]
-            for results in results_by_sample_id.values()
-        ],
+        np.array([result.target_score for result in grouped_results]),
+        np.array([result.comparator_score for result in grouped_results]),
+        counts=[len(results) for results in results_by_sample_id.values()],
     )
 
     # Reformat EfficacySample -> ParaphraseSample
@@ -699,10 +853,13 @@ def counterfact_generation(
     editor: editors.Editor | None = None,
     mt: models.ModelAndTokenizer | None = None,
     attribute_snippets: data.AttributeSnippets | None = None,
+    references_by_id: dict[str, list[str]] | None = None,
     tfidf_vectorizer: TfidfVectorizer | None = None,
     max_length: int | None = None,
     max_new_tokens: int | None = None,
     top_k_sampling: int = DEFAULT_TOP_K_SAMPLING,
+    flatten: bool = True,
+    keep_generations: bool = True,
     desc: str | None = None,
     **kwargs: Any,
 ) -> CounterFactGenerationBenchmarkResults:
@@ -719,12 +876,27 @@ def counterfact_generation(
 
         prompts = sample["source"]["generation_prompts"]
 
+    As with `counterfact_paraphrase`, pass `flatten=False` if the dataset was
+    already flattened with `counterfact_select_and_flatten`. Likewise, the
+    consistency references do not depend on the editor, so when benchmarking many
+    editors, compute them once with `counterfact_generation_references` and pass
+    them as `references_by_id`.
+
+    Each sample is scored as soon as its generations are grouped, after which its
+    raw texts are released. Set `keep_generations=False` to also leave them out of
+    the returned samples (their `generations` and `references` will be empty), so
+    only the scores are kept in memory and serialized.
+
     """
     if (mt is None) == (editor is None):
         raise ValueError("must set one of `editor` or `mt`, not both")
 
-    if attribute_snippets is None:
-        attribute_snippets = data.load_attribute_snippets()
+    if references_by_id is None:
+        if attribute_snippets is None:
+            attribute_snippets = data.load_attribute_snippets()
+        references_by_id = counterfact_generation_references(
+            dataset, attribute_snippets
+        )
     if tfidf_vectorizer is None:
         tfidf_vectorizer = data.load_counterfact_tfidf_vectorizer()
     if max_new_tokens is None and max_length is None:
@@ -732,9 +904,10 @@ def counterfact_generation(
     if desc is None:
         desc = "generate benchmark"
 
-    dataset = _counterfact_select_and_flatten(
-        dataset, "generation_prompts", desc=f"{desc} [flatten dataset]"
-    )
+    if flatten:
+        dataset = counterfact_select_and_flatten(
+            dataset, "generation_prompts", desc=f"{desc} [flatten dataset]"
+        )
 
     evaluate_kwargs = dict(
         max_new_tokens=max_new_tokens,
@@ -754,18 +927,14 @@ def counterfact_generation(
         run = editor.evaluate(dataset, return_before=False, **evaluate_kwargs)
         generations_key = "after_generations"
     run_results_by_id = _group_results_by_id(run)
+    del run
 
     samples = []
-    for sid, results in tqdm(run_results_by_id.items(), desc=f"{desc} [tfidf]"):
+    for _ in tqdm(range(len(run_results_by_id)), desc=f"{desc} [tfidf]"):
+        sid, results = run_results_by_id.popitem(last=False)
         result = next(iter(results))
-        cf_requested_rewrite = result.sample["source"]["requested_rewrite"]
-        relation_id = cf_requested_rewrite["relation_id"]
-        target_id = cf_requested_rewrite["target_new"]["id"]
-
         generations = [getattr(result, generations_key)[0] for result in results]
-        references = [
-            snippet["text"] for snippet in attribute_snippets[relation_id][target_id]
-        ]
+        references = references_by_id[sid]
 
         consistency_score = metrics.tfidf_similarity(
             generations, references, tfidf_vectorizer
@@ -780,8 +949,8 @@ def counterfact_generation(
 
         sample = GenerationSample(
             id=sid,
-            generations=generations,
-            references=references,
+            generations=generations if keep_generations else [],
+            references=references if keep_generations else [],
             fluency_score=fluency_score,
             consistency_score=consistency_score,
         )
@@ -799,29 +968,77 @@ def counterfact_generation(
     )
 
 
-def _counterfact_select_and_flatten(
-    dataset: Dataset, column: str, desc: str | None = None
-) -> Dataset:
-    """Select the given column in counterfact, dedupe it, and flatten it."""
-    column_names = data.column_names(dataset)
+def counterfact_generation_references(
+    dataset: Dataset, attribute_snippets: data.AttributeSnippets
+) -> dict[str, list[str]]:
+    """Look up the consistency references for each CounterFact sample.
 
-    def select_and_flatten_counterfact_row(row: dict) -> dict:
-        prompts = list(set(row["source"][0][column]))
-        result = {"prompt": prompts}
-        for key in data.ContextMediationSample.__required_keys__:
-            if key not in result:
-                result[key] = [row[key][0]] * len(prompts)
-        return result
+    These are the attribute snippets for each sample's requested relation and new
+    target, i.e. texts about other entities that have the edited attribute.
+
+    Args:
+        dataset: CounterFact dataset, flattened or not.
+        attribute_snippets: Snippets from `data.load_attribute_snippets`.
+
+    Returns:
+        Mapping from sample ID to its reference texts.
+
+    """
+    references_by_id = {}
+    for sid, source in zip(dataset["id"], dataset["source"]):
+        if sid in references_by_id:
+            continue
+        cf_requested_rewrite = source["requested_rewrite"]
+        relation_id = cf_requested_rewrite["relation_id"]
+        target_id = cf_requested_rewrite["target_new"]["id"]
+        references_by_id[sid] = [
+            snippet["text"] for snippet in attribute_snippets[relation_id][target_id]
+        ]
+    return references_by_id
 
+
+def counterfact_select_and_flatten(
+    dataset: Dataset,
+    column: str,
+    batch_size: int = 1000,
+    num_proc: int | None = None,
+    desc: str | None = None,
+) -> Dataset:
+    """Select the given column in counterfact, dedupe it, and flatten it.
+
+    Prompts are deduped in order of first appearance, so the flattened dataset is
+    the same from run to run.
+    """
     return dataset.map(
-        select_and_flatten_counterfact_row,
+        partial(_select_and_flatten_counterfact_rows, column=column),
         batched=True,
-        batch_size=1,
-        remove_columns=column_names,
+        batch_size=batch_size,
+        num_proc=num_proc,
+        remove_columns=data.column_names(dataset),
         desc=desc,
     )
 
 
+def _select_and_flatten_counterfact_rows(rows: dict, column: str) -> dict:
+    """Flatten a batch of counterfact rows, one output row per unique prompt.
+
+    Defined at module level (rather than as a closure) so the datasets fingerprint
+    of the map is stable across runs and its cache can be reused.
+    """
+    prompts = [list(dict.fromkeys(source[column])) for source in rows["source"]]
+    counts = [len(ps) for ps in prompts]
+    result = {"prompt": list(chain.from_iterable(prompts))}
+    for key in data.ContextMediationSample.__required_keys__:
+        if key == "prompt":
+            continue
+        result[key] = list(
+            chain.from_iterable(
+                [value] * count for value, count in zip(rows[key], counts)
+            )
+        )
+    return result
+
+
 def _group_results_by_id(results: editors.EditorEvaluateRun) -> OrderedDict:
     """Group results by sample ID."""
     grouped = defaultdict(list)
@@ -1247,8 +1464,7 @@ def biosbias_error_classification(
         logger.info(f"control_task=True (seed={control_task_seed}), shuffling labels")
         y_true = _make_control_task(y_true, seed=control_task_seed)
 
-    f1 = f1_score(y_true, y_pred)
-    mcc = matthews_corrcoef(y_true, y_pred)
+    _, f1, mcc = metrics.binary_classification_scores(y_true, y_pred)
     probe_recall_1 = sum(probe_recalled_1) / len(probe_recalled_1)
     probe_recall_k = sum(probe_recalled_k) / len(probe_recalled_k)
     model_recall_1 = sum(model_recalled_1) / len(model_recalled_1)
@@ -1,6 +1,7 @@
 """Datasets for evaluating context mediation in LMs."""
 import argparse
 import csv
+import hashlib
 import json
 import logging
 import pickle
@@ -892,11 +893,41 @@ def load_counterfact_tfidf_vectorizer(
     vocab_file: Path | None = None,
     idf_url: str = TFIDF_IDF_URL,
     vocab_url: str = TFIDF_VOCAB_URL,
+    cache_file: Path | None = None,
     overwrite: bool = False,
 ) -> TfidfVectorizer:
-    """Load precomputed TF-IDF statistics."""
+    """Load precomputed TF-IDF statistics.
+
+    The first load also writes the idf and vocab to a single .npz cache, which is
+    much faster to read back than the JSON vocab. The default cache file is named
+    after both source files, so different idf/vocab files never share a cache.
+
+    Args:
+        idf_file: Path to idf .npy file. Defaults to one in the data dir.
+        vocab_file: Path to vocab .json file. Defaults to one in the data dir.
+        idf_url: Where to download the idf file from if it does not exist.
+        vocab_url: Where to download the vocab file from if it does not exist.
+        cache_file: Path to the .npz cache. Defaults to one next to the idf file.
+        overwrite: Redownload the stats and rebuild the cache.
+
+    Returns:
+        The TF-IDF vectorizer.
+
+    """
     idf_file = _determine_file(idf_file, idf_url)
     vocab_file = _determine_file(vocab_file, vocab_url)
+    if cache_file is None:
+        key = hashlib.sha1(f"{idf_file}:{vocab_file}".encode()).hexdigest()[:8]
+        cache_file = idf_file.with_name(f"tfidf_stats_{key}.npz")
+
+    if cache_file.exists() and not overwrite:
+        logger.debug(f"loading cached tfidf stats from {cache_file}")
+        with numpy.load(str(cache_file)) as stats:
+            idf = stats["idf"]
+            words = stats["vocab"].tolist()
+        vocab = dict(zip(words, range(len(words))))
+        return _tfidf_vectorizer_from_stats(idf, vocab)
+
     for file, url in ((idf_file, idf_url), (vocab_file, vocab_url)):
         if not file.exists() or overwrite:
             _download_file(file, url)
@@ -905,6 +936,16 @@ def load_counterfact_tfidf_vectorizer(
     with vocab_file.open("r") as handle:
         vocab = json.load(handle)
 
+    logger.debug(f"caching tfidf stats to {cache_file}")
+    numpy.savez(str(cache_file), idf=idf, vocab=sorted(vocab, key=vocab.__getitem__))
+
+    return _tfidf_vectorizer_from_stats(idf, vocab)
+
+
+def _tfidf_vectorizer_from_stats(
+    idf: numpy.ndarray, vocab: dict[str, int]
+) -> TfidfVectorizer:
+    """Create a TF-IDF vectorizer from precomputed idf and vocab."""
     # Hack borrowed from ROME:
     # https://github.com/kmeng01/rome/blob/0874014cd9837e4365f3e6f3c71400ef11509e04/dsets/tfidf_stats.py#L17
     class ModifiedTfidfVectorizer(TfidfVectorizer):
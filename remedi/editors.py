@@ -1,6 +1,7 @@
 """Editing models."""
 import argparse
 import contextlib
+import io
 import logging
 from collections import defaultdict
 from dataclasses import dataclass
@@ -51,6 +52,8 @@ class apply_direction(contextlib.AbstractContextManager):
         layer: The layer to apply the directions at.
         directions: Directions to apply. Needs shape (batch_size, hidden_size).
         token_ranges: Token ranges to apply direction at. Needs shape (batch_size, 2).
+            If the model inputs have more rows than this, only the first batch_size
+            rows are edited; the rest run through the model unedited.
         alpha: Weight of edit direction when applying edit direction.
         beta: Weight of entity token when applying edit direction.
 
@@ -715,6 +718,19 @@ class Editor(nn.Module):
             exclude_columns.append("target_unmediated")
         columns = data.column_names(dataset, exclude=exclude_columns)
 
+        generate_kwargs: dict = dict(
+            return_dict_in_generate=True,
+            output_scores=True,
+            pad_token_id=self.mt.tokenizer.eos_token_id,
+        )
+        if top_k is not None:
+            generate_kwargs["do_sample"] = True
+            generate_kwargs["top_k"] = top_k
+        if max_length is not None:
+            generate_kwargs["max_length"] = max_length
+        if max_new_tokens is not None:
+            generate_kwargs["max_new_tokens"] = max_new_tokens
+
         results = []
         with dataset.formatted_as("torch", columns=columns):
             loader = torch.utils.data.DataLoader(
@@ -744,19 +760,6 @@ class Editor(nn.Module):
                         self.mt, prompts, device=device
                     )
 
-                generate_kwargs = dict(
-                    return_dict_in_generate=True,
-                    output_scores=True,
-                    pad_token_id=self.mt.tokenizer.eos_token_id,
-                )
-                if top_k is not None:
-                    generate_kwargs["do_sample"] = True
-                    generate_kwargs["top_k"] = top_k
-                if max_length is not None:
-                    generate_kwargs["max_length"] = max_length
-                if max_new_tokens is not None:
-                    generate_kwargs["max_new_tokens"] = max_new_tokens
-
                 outputs_before = None
                 if return_before:
                     outputs_before = self.mt.model.generate(**inputs, **generate_kwargs)
@@ -1179,8 +1182,16 @@ def load_editor(
     layer: int,
     editors_dir: PathLike | None = None,
     device: Device | None = None,
+    mmap: bool = True,
 ) -> Editor | None:
-    """Load editor of given type from the directory, assuming default options."""
+    """Load editor of given type from the directory, assuming default options.
+
+    Weights are loaded with `weights_only=True`, so they must be saved as a plain
+    state dict (see `save_editor`). By default the weights file is memory mapped
+    instead of read into RAM up front. On network filesystems, page faults during
+    the copy into the editor can be slower than one big read, so set `mmap=False`
+    to read the whole file first.
+    """
     editor_factory = SUPPORTED_EDITORS[editor_type]
     editor = editor_factory(mt=mt, layer=layer)
     editor.to(device)
@@ -1196,7 +1207,14 @@ def load_editor(
             return None
 
         logger.info(f"loading editor weights from {weights_file}")
-        state_dict = torch.load(weights_file, map_location=device)
+        if mmap:
+            state_dict = torch.load(
+                weights_file, map_location=device, weights_only=True, mmap=True
+            )
+        else:
+            with weights_file.open("rb") as handle:
+                buffer = io.BytesIO(handle.read())
+            state_dict = torch.load(buffer, map_location=device, weights_only=True)
         editor.load_state_dict(state_dict)
 
     return editor
@@ -1261,6 +1279,8 @@ def add_editor_args(parser: argparse.ArgumentParser) -> None:
             layout like: <editors_dir> / <editor_type> / <layer> / weights.pth
         --layers (-l): Usually we want to play with editing at multiple layers.
             This arg specifies which layers to try editors for.
+        --weight-loader-disable-mmap: Read editor weights fully into memory instead
+            of memory mapping them. Useful on network filesystems.
 
     """
     parser.add_argument(
@@ -1276,3 +1296,8 @@ def add_editor_args(parser: argparse.ArgumentParser) -> None:
     parser.add_argument(
         "--layers", "-l", nargs="+", type=int, help="layers to apply remedi at"
     )
+    parser.add_argument(
+        "--weight-loader-disable-mmap",
+        action="store_true",
+        help="read editor weights into memory instead of memory mapping them",
+    )
@@ -4,7 +4,9 @@ Lots of this code is taken from the ROME CounterFact evaluation, for which the s
 code can be found: https://github.com/kmeng01/rome/blob/main/experiments/py/eval_utils_counterfact.py
 """
 import logging
+import math
 from dataclasses import dataclass
+from itertools import chain
 from typing import Any, Sequence
 
 from remedi.utils.typing import ArrayLike, StrSequence
@@ -13,6 +15,7 @@ import nltk
 import numpy as np
 from dataclasses_json import DataClassJsonMixin
 from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics import confusion_matrix
 from tqdm.auto import tqdm
 
 logger = logging.getLogger(__name__)
@@ -54,10 +57,11 @@ class EfficacyMetrics(DataClassJsonMixin):
 
 
 def efficacy(
-    p_targets: Sequence[ArrayLike],
-    p_comparators: Sequence[ArrayLike],
+    p_targets: Sequence[ArrayLike] | ArrayLike,
+    p_comparators: Sequence[ArrayLike] | ArrayLike,
     assume_log_probs: bool = True,
     store_values: bool = True,
+    counts: ArrayLike | None = None,
 ) -> EfficacyMetrics:
     """Compute efficacy on metrics.
 
@@ -67,9 +71,39 @@ def efficacy(
     Inputs are two sequences. Each element should be one or more measurements of
     the probability (for e.g. different prompts). This function will first average
     across those inner lists, then average across the whole list.
+
+    Alternatively, if `counts` is set, inputs are flat arrays with one measurement
+    each, where the first `counts[0]` measurements belong to the first group (e.g.
+    sample), the next `counts[1]` to the second, and so on. This is equivalent to,
+    but much faster than, passing one inner list per group.
     """
     _validate_same_length(p_targets=p_targets, p_comparators=p_comparators)
 
+    if counts is not None:
+        group_sizes = np.asarray(counts, dtype=np.int64)
+        if group_sizes.sum() != len(p_targets) or (group_sizes <= 0).any():
+            raise ValueError(
+                f"counts must be positive and sum to {len(p_targets)}: {counts}"
+            )
+        p_target = np.asarray(p_targets, dtype=np.float64)
+        p_comparator = np.asarray(p_comparators, dtype=np.float64)
+        if assume_log_probs:
+            p_target = np.exp(p_target)
+            p_comparator = np.exp(p_comparator)
+
+        starts = np.concatenate(([0], np.cumsum(group_sizes)[:-1]))
+        correct = (p_target > p_comparator).astype(np.float64)
+        margins = p_target - p_comparator
+        group_scores = np.add.reduceat(correct, starts) / group_sizes
+        group_magnitudes = np.add.reduceat(margins, starts) / group_sizes
+
+        return EfficacyMetrics(
+            score=Metric.aggregate(group_scores.tolist(), store_values=store_values),
+            magnitude=Metric.aggregate(
+                group_magnitudes.tolist(), store_values=store_values
+            ),
+        )
+
     scores, magnitudes = [], []
     for i, (p_target, p_comparator) in enumerate(zip(p_targets, p_comparators)):
         _validate_same_length(
@@ -121,12 +155,69 @@ def tfidf_similarity(
     tfidf_vectorizer: TfidfVectorizer,
 ) -> float:
     """Return TfIdf similarity between the texts."""
-    if isinstance(source, str):
-        source = [source]
-    if isinstance(reference, str):
-        reference = [reference]
-    sv, rv = tfidf_vectorizer.transform([" ".join(source), " ".join(reference)]).A
-    return vector_similarity(sv, rv)
+    [similarity] = batch_tfidf_similarity([source], [reference], tfidf_vectorizer)
+    return similarity.item()
+
+
+def batch_tfidf_similarity(
+    sources: Sequence[str | StrSequence],
+    references: Sequence[str | StrSequence],
+    tfidf_vectorizer: TfidfVectorizer,
+    eps: float = 1e-6,
+) -> np.ndarray:
+    """Return TfIdf similarity between each source and its reference.
+
+    All texts are vectorized with a single call to the vectorizer, and similarities
+    are computed directly on the sparse TF-IDF matrix.
+
+    Args:
+        sources: The source texts. Each element is one text or several texts,
+            which will be joined with spaces.
+        references: The reference texts, same format as `sources`.
+        tfidf_vectorizer: The fitted vectorizer.
+        eps: Added to norms to avoid division by zero.
+
+    Returns:
+        Array of shape (len(sources),) containing the similarities.
+
+    """
+    _validate_same_length(sources=sources, references=references)
+    texts = [
+        text if isinstance(text, str) else " ".join(text)
+        for text in chain(sources, references)
+    ]
+    vectors = tfidf_vectorizer.transform(texts).tocsr()
+    svs, rvs = vectors[: len(sources)], vectors[len(sources) :]
+    dots = np.asarray(svs.multiply(rvs).sum(axis=1)).squeeze(axis=1)
+    s_norms = np.sqrt(np.asarray(svs.multiply(svs).sum(axis=1))).squeeze(axis=1)
+    r_norms = np.sqrt(np.asarray(rvs.multiply(rvs).sum(axis=1))).squeeze(axis=1)
+    return dots / (s_norms + eps) / (r_norms + eps)
+
+
+def binary_classification_scores(
+    y_true: ArrayLike, y_pred: ArrayLike
+) -> tuple[float, float, float]:
+    """Compute accuracy, F1, and MCC for binary labels from one confusion matrix.
+
+    Args:
+        y_true: True boolean labels.
+        y_pred: Predicted boolean labels.
+
+    Returns:
+        Accuracy, F1 score of the positive class, and Matthews correlation
+        coefficient. Like sklearn, F1 and MCC are 0 when undefined.
+
+    """
+    _validate_same_length(y_true=y_true, y_pred=y_pred)
+    tn, fp, fn, tp = (
+        confusion_matrix(y_true, y_pred, labels=[False, True]).ravel().tolist()
+    )
+
+    accuracy = (tp + tn) / (tp + tn + fp + fn)
+    f1 = 2 * tp / (2 * tp + fp + fn) if tp else 0.0
+    mcc_denominator = math.sqrt((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn))
+    mcc = (tp * tn - fp * fn) / mcc_denominator if mcc_denominator else 0.0
+    return accuracy, f1, mcc
 
 
 def vector_similarity(a: np.ndarray, b: np.ndarray, eps: float = 1e-6) -> float:
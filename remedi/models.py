@@ -192,6 +192,37 @@ def map_to(
     return result
 
 
+def hf_name(name: str) -> str:
+    """Map short model names (e.g. gptj) to their huggingface names."""
+    if name == GPT_J_NAME_SHORT:
+        return GPT_J_NAME
+    elif name == GPT_NEO_X_NAME_SHORT:
+        return GPT_NEO_X_NAME
+    return name
+
+
+def default_fp16(name: str) -> bool:
+    """Determine whether the model should use half precision by default.
+
+    This is true for GPT-J and NeoX, including any variants of them.
+    """
+    name = hf_name(name)
+    return _is_gpt_j_variant(name) or _is_neo_x_variant(name)
+
+
+def _is_gpt_j_variant(name: str) -> bool:
+    """Check if the (huggingface) model name is GPT-J or a variant of it."""
+    # I usually save randomly initialized variants under the short name of the
+    # corresponding real model (e.g. gptj_random, neox_random), so check here
+    # if we are dealing with *any* variant of the big model.
+    return name == GPT_J_NAME or GPT_J_NAME_SHORT in name
+
+
+def _is_neo_x_variant(name: str) -> bool:
+    """Check if the (huggingface) model name is NeoX or a variant of it."""
+    return name == GPT_NEO_X_NAME or GPT_NEO_X_NAME_SHORT in name
+
+
 def load_model(
     name: str, device: Optional[Device] = None, fp16: Optional[bool] = None
 ) -> ModelAndTokenizer:
@@ -206,24 +237,17 @@ def load_model(
         ModelAndTokenizer: Loaded model and its tokenizer.
 
     """
-    if name == GPT_J_NAME_SHORT:
-        name = GPT_J_NAME
-    elif name == GPT_NEO_X_NAME_SHORT:
-        name = GPT_NEO_X_NAME
-
-    # I usually save randomly initialized variants under the short name of the
-    # corresponding real model (e.g. gptj_random, neox_random), so check here
-    # if we are dealing with *any* variant of the big model.
-    is_gpt_j_variant = name == GPT_J_NAME or GPT_J_NAME_SHORT in name
-    is_neo_x_variant = name == GPT_NEO_X_NAME or GPT_NEO_X_NAME_SHORT in name
+    name = hf_name(name)
+    is_gpt_j_variant = _is_gpt_j_variant(name)
+    is_neo_x_variant = _is_neo_x_variant(name)
 
     if fp16 is None:
-        fp16 = is_gpt_j_variant or is_neo_x_variant
+        fp16 = default_fp16(name)
 
     torch_dtype = torch.float16 if fp16 else None
 
     kwargs: dict = dict(torch_dtype=torch_dtype)
-    if name == GPT_J_NAME or GPT_J_NAME_SHORT in name:
+    if is_gpt_j_variant:
         kwargs["low_cpu_mem_usage"] = True
         if fp16:
             kwargs["revision"] = "float16"
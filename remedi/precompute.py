@@ -503,11 +503,16 @@ def prompt_in_context_from_batch(
 
 
 def prompt_in_context_from_dataset(
-    dataset: Dataset, desc: str | None = "precompute prompt in context", **kwargs: Any
+    dataset: Dataset,
+    batch_size: int = 1000,
+    desc: str | None = "precompute prompt in context",
+    **kwargs: Any,
 ) -> Dataset:
     """Compute prompt in context for whole dataset."""
     return dataset.map(
         partial(prompt_in_context_from_batch, **kwargs),
+        batched=True,
+        batch_size=batch_size,
         desc=desc,
         keep_in_memory=True,
     )
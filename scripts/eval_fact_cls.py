@@ -38,7 +38,12 @@ def main(args: argparse.Namespace) -> None:
 
     for editor_layer in editor_layers:
         editor = editors.load_editor(
-            mt, editor_type, editor_layer, editors_dir=editors_dir, device=device
+            mt,
+            editor_type,
+            editor_layer,
+            editors_dir=editors_dir,
+            device=device,
+            mmap=not args.weight_loader_disable_mmap,
         )
         if editor is None:
             logger.warning(f"skipping benchmark for editor layer {editor_layer}")
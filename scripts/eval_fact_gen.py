@@ -8,11 +8,14 @@ from pathlib import Path
 from typing import cast
 
 from remedi import benchmarks, data, editors, models, precompute
-from remedi.utils import experiment_utils, logging_utils
+from remedi.utils import experiment_utils, logging_utils, training_utils
 from remedi.utils.typing import Dataset, Device
 
+import numpy as np
 import torch
+import torch.multiprocessing
 import torch.utils.data
+from sklearn.feature_extraction.text import TfidfVectorizer
 from tqdm.auto import tqdm
 
 logger = logging.getLogger(__name__)
@@ -25,24 +28,26 @@ BENCHMARKS = (
 )
 
 
-def _prefix_context(sample: dict) -> dict:
+def _prefix_context(batch: dict) -> dict:
     """Prepend context to all prompts used in the eval."""
-    entity = sample["entity"]
-    prompt = sample["prompt"]
-    context = sample["context"]
-
-    prompt_in_context = precompute.prompt_in_context_from_sample(
-        entity, prompt, context
-    )
+    prompts_in_context = []
+    sources = []
+    for entity, prompt, context, source in zip(
+        batch["entity"], batch["prompt"], batch["context"], batch["source"]
+    ):
+        prompts_in_context.append(
+            precompute.prompt_in_context_from_sample(entity, prompt, context)
+        )
 
-    source = {**sample["source"]}
-    for key in ("generation_prompts", "paraphrase_prompts"):
-        source[key] = [
-            precompute.prompt_in_context_from_sample(entity, other_prompt, context)
-            for other_prompt in source[key]
-        ]
+        source = {**source}
+        for key in ("generation_prompts", "paraphrase_prompts"):
+            source[key] = [
+                precompute.prompt_in_context_from_sample(entity, other_prompt, context)
+                for other_prompt in source[key]
+            ]
+        sources.append(source)
 
-    return {"source": source, "prompt": prompt_in_context}
+    return {"source": sources, "prompt": prompts_in_context}
 
 
 def _prefix_essence_prompt_template(sample: dict) -> str:
@@ -87,9 +92,20 @@ def _replace_entity(attribute_snippets: data.AttributeSnippets, sample: dict) ->
 
 @torch.inference_mode()
 def _precompute_essence_references(
-    mt: models.ModelAndTokenizer, dataset: Dataset, device: Device | None = None
+    mt: models.ModelAndTokenizer,
+    dataset: Dataset,
+    device: Device | None = None,
+    bf16: bool = False,
+    compile_forward: bool = False,
 ) -> list[list[str]]:
-    """Precompute essence references to save some compute."""
+    """Precompute essence references to save some compute.
+
+    References come from the unedited model, so this can optionally run in bf16
+    autocast and/or with a compiled forward. Neither changes the model's weights
+    or dtype, which the editor eval afterward still uses. Autocast only helps fp32
+    models; half precision models (e.g. the GPT-J and NeoX defaults) should not
+    set `bf16`.
+    """
     prompts = [
         benchmarks.DEFAULT_PROMPT_PREFIX
         + benchmarks.DEFAULT_PROMPT_TEMPLATE.format(x["entity"])
@@ -99,21 +115,35 @@ def _precompute_essence_references(
         cast(torch.utils.data.Dataset, prompts),
         batch_size=editors.DEFAULT_BATCH_SIZE,
     )
+
+    device_type = torch.device(device).type if device is not None else "cpu"
+    autocast = torch.autocast(device_type, dtype=torch.bfloat16, enabled=bf16)
+
+    if compile_forward:
+        logger.info("compiling model forward for essence references")
+        mt.model.forward = torch.compile(mt.model.forward, mode="max-autotune")
+
     references = []
-    for batch in tqdm(loader, desc="precompute essence refs"):
-        with models.set_padding_side(mt, padding_side="left"):
-            inputs, _ = precompute.inputs_from_batch(mt, batch, device=device)
-        outputs = mt.model.generate(
-            **inputs,
-            max_length=benchmarks.DEFAULT_MAX_LENGTH,
-            do_sample=True,
-            top_k=benchmarks.DEFAULT_TOP_K_SAMPLING,
-            pad_token_id=mt.tokenizer.eos_token_id,
-        )
-        references += [
-            [r[len(benchmarks.DEFAULT_PROMPT_PREFIX) :]]
-            for r in mt.tokenizer.batch_decode(outputs, skip_special_tokens=True)
-        ]
+    try:
+        for batch in tqdm(loader, desc="precompute essence refs"):
+            with models.set_padding_side(mt, padding_side="left"):
+                inputs, _ = precompute.inputs_from_batch(mt, batch, device=device)
+            with autocast:
+                outputs = mt.model.generate(
+                    **inputs,
+                    max_length=benchmarks.DEFAULT_MAX_LENGTH,
+                    do_sample=True,
+                    top_k=benchmarks.DEFAULT_TOP_K_SAMPLING,
+                    pad_token_id=mt.tokenizer.eos_token_id,
+                )
+            references += [
+                [r[len(benchmarks.DEFAULT_PROMPT_PREFIX) :]]
+                for r in mt.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+            ]
+    finally:
+        # Drop the instance attribute so the class's forward is used again.
+        if compile_forward:
+            del mt.model.forward
     return references
 
 
@@ -121,9 +151,15 @@ def main(args: argparse.Namespace) -> None:
     """Run the benchmark."""
     experiment = experiment_utils.setup_experiment(args)
     logging_utils.configure(args=args)
-    data.disable_caching()
 
-    device = args.device or "cuda" if torch.cuda.is_available() else "cpu"
+    if args.gpus is not None:
+        if args.device is not None:
+            raise ValueError("cannot set --device with --gpus")
+        # Precomputation, and the whole eval if it does not fan out, uses the
+        # first requested GPU.
+        device = f"cuda:{args.gpus[0]}"
+    else:
+        device = args.device or "cuda" if torch.cuda.is_available() else "cpu"
     mt = models.load_model(args.model, device=device, fp16=args.fp16)
 
     logger.info("loading several data sources")
@@ -138,23 +174,41 @@ def main(args: argparse.Namespace) -> None:
 
     essence_references = None
     if "essence" in args.benchmarks:
-        essence_refs_file = experiment.results_dir / "essence_references.json"
+        bf16_references = args.bf16_references
+        if bf16_references and mt.model.dtype != torch.float32:
+            logger.warning(
+                f"model is already {mt.model.dtype}, ignoring --bf16-references"
+            )
+            bf16_references = False
+
+        # References are stored as a flat numpy string array, which is much faster
+        # to load than JSON; older runs stored them as JSON, so still read those.
+        # bf16 references are cached separately so they are never mixed up with
+        # full precision ones.
+        essence_refs_name = "essence_references"
+        if bf16_references:
+            essence_refs_name += "_bf16"
+        essence_refs_file = experiment.results_dir / f"{essence_refs_name}.npy"
+        essence_refs_json_file = essence_refs_file.with_suffix(".json")
         if essence_refs_file.exists():
             logger.info(f"found essence refs at {essence_refs_file}")
-            with essence_refs_file.open("r") as handle:
+            essence_references = [[l] for l in np.load(essence_refs_file).tolist()]
+        elif essence_refs_json_file.exists():
+            logger.info(f"found essence refs at {essence_refs_json_file}")
+            with essence_refs_json_file.open("r") as handle:
                 essence_references = [[l] for l in json.load(handle)["references"]]
         else:
             essence_references = _precompute_essence_references(
-                mt, dataset, device=device
+                mt,
+                dataset,
+                device=device,
+                bf16=bf16_references,
+                compile_forward=args.compile_references,
             )
 
             logger.info(f"saving precomputed references to {essence_refs_file}")
             essence_refs_file.parent.mkdir(exist_ok=True, parents=True)
-            with essence_refs_file.open("w") as handle:
-                json.dump(
-                    {"references": [rs[0] for rs in essence_references]},
-                    handle,
-                )
+            np.save(essence_refs_file, np.array([rs[0] for rs in essence_references]))
 
     baseline = args.baseline
     if baseline is not None:
@@ -173,7 +227,9 @@ def main(args: argparse.Namespace) -> None:
         )
 
         if baseline == "prefix":
-            dataset = dataset.map(_prefix_context, desc="prefix context")
+            dataset = dataset.map(
+                _prefix_context, batched=True, batch_size=1000, desc="prefix context"
+            )
         elif baseline == "replace":
             dataset = dataset.map(
                 partial(_replace_entity, attribute_snippets), desc="replace entities"
@@ -198,11 +254,125 @@ def main(args: argparse.Namespace) -> None:
             layers = editors.list_saved_editors(args.editors_dir)[editor_type]
         logger.info(f"found {editor_type} editors for layers: {layers}")
 
+    # Essence reads batches straight from Arrow by default, which is usually fast
+    # enough. DataLoader workers can still help on some machines, at the cost of
+    # process startup, so optionally time a few batches and use the fastest count.
+    num_workers = args.num_workers
+    if args.autotune_num_workers and "essence" in args.benchmarks:
+        num_workers = training_utils.autotune_num_workers(
+            dataset.with_format("torch"), batch_size=editors.DEFAULT_BATCH_SIZE
+        )
+
+    # Flattening the paraphrase/generation prompts does not depend on the layer,
+    # so do it once here instead of once per layer inside each benchmark.
+    flattened_datasets = {
+        benchmark_name: benchmarks.counterfact_select_and_flatten(
+            dataset, column, desc=f"flatten {column}"
+        )
+        for benchmark_name, column in (
+            ("paraphrase", "paraphrase_prompts"),
+            ("generation", "generation_prompts"),
+        )
+        if benchmark_name in args.benchmarks
+    }
+
+    generation_references = None
+    if "generation" in args.benchmarks:
+        generation_references = benchmarks.counterfact_generation_references(
+            dataset, attribute_snippets
+        )
+
+    eval_kwargs: dict = dict(
+        args=args,
+        experiment=experiment,
+        dataset=dataset,
+        flattened_datasets=flattened_datasets,
+        generation_references=generation_references,
+        essence_references=essence_references,
+        num_workers=num_workers,
+        editor_type=editor_type,
+        editors_dir=editors_dir,
+        baseline=baseline,
+    )
+
+    gpus = args.gpus
+    if gpus is None or len(gpus) < 2 or len(layers) < 2:
+        _evaluate_layers(
+            layers,
+            mt=mt,
+            device=device,
+            tfidf_vectorizer=tfidf_vectorizer,
+            **eval_kwargs,
+        )
+        return
+
+    # Each layer's editor is evaluated independently, so shard the layers across
+    # GPUs. Every worker loads its own copy of the model, so free this one first.
+    world_size = min(len(gpus), len(layers))
+    layer_shards = [layers[rank::world_size] for rank in range(world_size)]
+    logger.info(f"evaluating layers across gpus {gpus[:world_size]}: {layer_shards}")
+    del mt
+    torch.cuda.empty_cache()
+    torch.multiprocessing.spawn(
+        _evaluate_layers_on_gpu,
+        args=(layer_shards, gpus, eval_kwargs),
+        nprocs=world_size,
+    )
+
+
+def _evaluate_layers_on_gpu(
+    rank: int, layer_shards: list[list[int]], gpus: list[int], eval_kwargs: dict
+) -> None:
+    """Evaluate one shard of layers on one GPU; entry point for each worker."""
+    args = eval_kwargs["args"]
+    logging_utils.configure(args=args)
+    experiment_utils.set_seed(args.seed)
+
+    device = f"cuda:{gpus[rank]}"
+    torch.cuda.set_device(device)
+    mt = models.load_model(args.model, device=device, fp16=args.fp16)
+
+    # Reload rather than pickling it over: the TF-IDF vectorizer is an instance of
+    # a locally defined class, which cannot be pickled.
+    tfidf_vectorizer = data.load_counterfact_tfidf_vectorizer()
+
+    _evaluate_layers(
+        layer_shards[rank],
+        mt=mt,
+        device=device,
+        tfidf_vectorizer=tfidf_vectorizer,
+        **eval_kwargs,
+    )
+
+
+def _evaluate_layers(
+    layers: list[int],
+    *,
+    args: argparse.Namespace,
+    experiment: experiment_utils.Experiment,
+    mt: models.ModelAndTokenizer,
+    device: Device,
+    dataset: Dataset,
+    flattened_datasets: dict[str, Dataset],
+    generation_references: dict[str, list[str]] | None,
+    tfidf_vectorizer: TfidfVectorizer,
+    essence_references: list[list[str]] | None,
+    num_workers: int,
+    editor_type: str,
+    editors_dir: Path | None,
+    baseline: str | None,
+) -> None:
+    """Run every requested benchmark for each layer and save the results."""
     for layer in layers:
-        benchmark_kwargs: dict = dict(dataset=dataset, device=device)
+        benchmark_kwargs: dict = dict(device=device)
         if baseline is None:
             editor = editors.load_editor(
-                mt, editor_type, layer, editors_dir=editors_dir, device=device
+                mt,
+                editor_type,
+                layer,
+                editors_dir=editors_dir,
+                device=device,
+                mmap=not args.weight_loader_disable_mmap,
             )
             if editor is None:
                 logger.warning(f"skipping benchmark for layer {layer}")
@@ -238,23 +408,33 @@ def main(args: argparse.Namespace) -> None:
                 )
                 continue
 
-            essence_kwargs: dict = {}
+            essence_kwargs: dict = dict(
+                num_workers=num_workers, prefetch_factor=args.prefetch_factor
+            )
             if baseline == "prefix":
                 essence_kwargs["prompt_template"] = _prefix_essence_prompt_template
                 essence_kwargs["post_process"] = _prefix_essence_post_process
 
             if benchmark_name == "efficacy":
-                results = benchmarks.efficacy(**benchmark_kwargs)
+                results = benchmarks.efficacy(dataset=dataset, **benchmark_kwargs)
             elif benchmark_name == "paraphrase":
-                results = benchmarks.counterfact_paraphrase(**benchmark_kwargs)
+                results = benchmarks.counterfact_paraphrase(
+                    dataset=flattened_datasets["paraphrase"],
+                    flatten=False,
+                    **benchmark_kwargs,
+                )
             elif benchmark_name == "generation":
                 results = benchmarks.counterfact_generation(
-                    attribute_snippets=attribute_snippets,
+                    references_by_id=generation_references,
                     tfidf_vectorizer=tfidf_vectorizer,
+                    dataset=flattened_datasets["generation"],
+                    flatten=False,
+                    keep_generations=args.keep_generations,
                     **benchmark_kwargs,
                 )
             elif benchmark_name == "essence":
                 results = benchmarks.essence(
+                    dataset=dataset,
                     tfidf_vectorizer=tfidf_vectorizer,
                     use_references=essence_references,
                     **benchmark_kwargs,
@@ -296,6 +476,18 @@ if __name__ == "__main__":
     parser.add_argument(
         "--layers", "-l", nargs="+", type=int, help="layers to test editors for"
     )
+    parser.add_argument(
+        "--weight-loader-disable-mmap",
+        action="store_true",
+        help="read editor weights into memory instead of memory mapping them",
+    )
+    parser.add_argument(
+        "--gpus",
+        nargs="+",
+        type=int,
+        help="gpu ids to spread the layers across, one worker process per gpu "
+        "(replaces --device)",
+    )
     parser.add_argument(
         "--baseline",
         choices=("prefix", "replace"),
@@ -304,6 +496,38 @@ if __name__ == "__main__":
     parser.add_argument(
         "--small", action="store_true", help="run on a small subset of data"
     )
+    parser.add_argument(
+        "--keep-generations",
+        action="store_true",
+        help="save generation benchmark texts, not just scores "
+        "(needed by notebooks/figures/examples.ipynb)",
+    )
+    parser.add_argument(
+        "--bf16-references",
+        action="store_true",
+        help="generate essence references under bf16 autocast (fp32 models only)",
+    )
+    parser.add_argument(
+        "--compile-references",
+        action="store_true",
+        help="torch.compile the model forward for essence references",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="essence dataloader workers (0 reads batches in the main process)",
+    )
+    parser.add_argument(
+        "--autotune-num-workers",
+        action="store_true",
+        help="time a few essence batches to pick --num-workers",
+    )
+    parser.add_argument(
+        "--prefetch-factor",
+        type=int,
+        help="batches prefetched per essence dataloader worker",
+    )
     # No dataset args because this only works for counterfact
     models.add_model_args(parser)
     precompute.add_preprocessing_args(parser)
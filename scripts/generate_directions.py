@@ -52,7 +52,12 @@ def main(args: argparse.Namespace) -> None:
             continue
 
         editor = editors.load_editor(
-            mt, args.editor_type, layer, editors_dir=args.editors_dir, device=device
+            mt,
+            args.editor_type,
+            layer,
+            editors_dir=args.editors_dir,
+            device=device,
+            mmap=not args.weight_loader_disable_mmap,
         )
         if editor is None:
             logger.warning(f"skipping dump for layer {layer}")
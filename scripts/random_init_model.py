@@ -6,6 +6,9 @@ from pathlib import Path
 from remedi import models
 from remedi.utils import env_utils, experiment_utils, logging_utils
 
+import torch
+import transformers
+
 logger = logging.getLogger(__name__)
 
 
@@ -13,12 +16,23 @@ def main(args: argparse.Namespace) -> None:
     """Randomly initialized the model and save it."""
     logging_utils.configure(args=args)
 
-    mt = models.load_model(args.model, device="cpu", fp16=args.fp16)
-    model = mt.model
+    # Only the config and tokenizer are needed: building the model from its config
+    # already randomly initializes it, so skip loading the pretrained weights.
+    name = models.hf_name(args.model)
+    fp16 = args.fp16
+    if fp16 is None:
+        fp16 = models.default_fp16(name)
+    torch_dtype = torch.float16 if fp16 else torch.float32
 
-    logger.info(f"reinitializating model with seed {args.seed}")
+    logger.info(f"randomly initializing {name} with seed {args.seed}")
     experiment_utils.set_seed(args.seed)
-    model.init_weights()
+    config = transformers.AutoConfig.from_pretrained(name)
+    model = transformers.AutoModelForCausalLM.from_config(
+        config, torch_dtype=torch_dtype
+    )
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(name)
+    tokenizer.pad_token = tokenizer.eos_token
 
     out_dir = args.out_dir
     if out_dir is None:
@@ -26,7 +40,7 @@ def main(args: argparse.Namespace) -> None:
 
     logger.info(f"saving randomized {args.model} to {out_dir}")
     model.save_pretrained(str(out_dir))
-    mt.tokenizer.save_pretrained(str(out_dir))
+    tokenizer.save_pretrained(str(out_dir))
 
 
 if __name__ == "__main__":
@@ -4,6 +4,7 @@ from remedi import metrics
 import numpy
 import pytest
 from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics import accuracy_score, f1_score, matthews_corrcoef
 
 
 @pytest.mark.parametrize(
@@ -63,3 +64,56 @@ def test_average_weighted_n_gram_entropy(texts, fluency):
     """Test average_weighted_n_gram_entropy correctly computes entropy."""
     actual = metrics.average_weighted_n_gram_entropy(texts)
     assert numpy.allclose(actual.mean, fluency, atol=1e-4)
+
+
+def test_batch_tfidf_similarity(tfidf_vectorizer):
+    """Test batch_tfidf_similarity matches per-sample tfidf_similarity."""
+    sources = ["dog cat", ["dog", "dog"], "cat"]
+    references = [["dog dog dog", "cat cat cat"], "cat", "cat cat"]
+    actual = metrics.batch_tfidf_similarity(sources, references, tfidf_vectorizer)
+    expected = [
+        metrics.tfidf_similarity(source, reference, tfidf_vectorizer)
+        for source, reference in zip(sources, references)
+    ]
+    assert numpy.allclose(actual, expected, atol=1e-4)
+    assert numpy.allclose(actual, [1.0, 0.0, 1.0], atol=1e-4)
+
+
+@pytest.mark.parametrize(
+    "p_targets,p_comparators",
+    (
+        ([[1]], [[0.5]]),
+        ([[0, 1], [0.5, 0.75, 1]], [[0.5, 0.5], [0.5, 0.75, 1]]),
+        ([[0.5, 0.75, 1], [0, 1]], [[0.5, 0, 1], [0.5, 0.5]]),
+    ),
+)
+def test_efficacy_counts(p_targets, p_comparators):
+    """Test efficacy on flat grouped inputs matches efficacy on nested inputs."""
+    expected = metrics.efficacy(p_targets, p_comparators, assume_log_probs=False)
+    actual = metrics.efficacy(
+        numpy.concatenate(p_targets),
+        numpy.concatenate(p_comparators),
+        assume_log_probs=False,
+        counts=[len(ps) for ps in p_targets],
+    )
+    assert numpy.allclose(actual.score.values, expected.score.values)
+    assert numpy.allclose(actual.magnitude.values, expected.magnitude.values)
+
+
+@pytest.mark.parametrize(
+    "y_true,y_pred",
+    (
+        ([True, False, True, True, False], [True, True, False, True, False]),
+        ([True, True, False], [True, True, False]),
+        ([False, False, False], [False, False, False]),
+        ([True, False, True], [False, False, False]),
+    ),
+)
+def test_binary_classification_scores(y_true, y_pred):
+    """Test binary_classification_scores matches sklearn."""
+    accuracy, f1, mcc = metrics.binary_classification_scores(
+        numpy.array(y_true), numpy.array(y_pred)
+    )
+    assert accuracy == pytest.approx(accuracy_score(y_true, y_pred))
+    assert f1 == pytest.approx(f1_score(y_true, y_pred, zero_division=0))
+    assert mcc == pytest.approx(matthews_corrcoef(y_true, y_pred))
@@ -1,6 +1,10 @@
 """Unit tests for the `src.utils.training_utils` module."""
 from remedi.utils import training_utils
 
+import datasets
+import torch
+from torch.utils import data
+
 PATIENCE = 5
 
 
@@ -58,3 +62,21 @@ def test_early_stopping_improved():
 
     early_stopping(-1)
     assert early_stopping.improved
+
+
+def test_autotune_num_workers():
+    """Test autotune_num_workers returns one of the candidates."""
+    dataset = data.TensorDataset(torch.arange(32))
+    actual = training_utils.autotune_num_workers(
+        dataset, batch_size=4, candidates=(0, 1)
+    )
+    assert actual in (0, 1)
+
+
+def test_autotune_num_workers_hf_dataset():
+    """Test autotune_num_workers handles huggingface datasets."""
+    dataset = datasets.Dataset.from_dict({"x": list(range(32))}).with_format("torch")
+    actual = training_utils.autotune_num_workers(
+        dataset, batch_size=4, candidates=(0, 1)
+    )
+    assert actual in (0, 1)